@@ -4,15 +4,21 @@
 __version__ = '0.0.9'
 
 import argparse
-from core import Patient, LimitedExam, PeriodicExam, ComprehensiveExam, Surgery, DATE_FORMAT, RUNTIME_ID
-from datetime import datetime, date
+import bisect
+from collections import Counter
+from core import Patient, EXAM_TYPES, DATE_FORMAT, RUNTIME_ID, intern_value, parse_date
+from datetime import date
+from itertools import chain, islice
 import logging
 from logging.handlers import RotatingFileHandler
-from storage import Repo
+from operator import attrgetter
+from storage import Repo, by_date
 import sys
 
 
 LOG_FILENAME = 'application.log'  # Default filename for saving logging information for this module.
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Log file size at which it is rolled over to a backup.
+LOG_BUFFER_CAPACITY = 1024  # Log records held in memory before they are written to the log file.
 DEFAULT_LOG_LEVEL = logging.DEBUG  # Default logging level.
 
 # Configure logging.
@@ -24,20 +30,50 @@ class Application:
     """Handles interaction between UI layer and other layers."""
 
     def __init__(self):
-        """(Initialization) Upon startup calls Repo to populate self.patients as a list of saved patient objects.
+        """(Initialization) Creates the Repo that populates self.patients as a list of saved patient objects.
 
         Args:
             None
         Return:
             None
+
+        Saved records are not read until self.repo is first used, so commands that never need them skip the load.
         """
 
-        self.repo = Repo()
-        self.repo.load()
-        self.patients = self.repo.patients  # List of patient objects.
+        self._repo = Repo()
+        self._repo_loaded = False  # Set to True once self._repo has loaded saved records.
 
         log.debug(f'({RUNTIME_ID}) Application() instantiated.')
 
+    @property
+    def repo(self):
+        """Repo holding all saved records. Records are loaded on first access."""
+
+        if not self._repo_loaded:
+            self._repo.load()
+            self._repo_loaded = True
+            log.debug(f'({RUNTIME_ID}) repo: Records loaded on first use.')
+
+        return self._repo
+
+    @property
+    def _by_mrn(self):
+        """Patient objects keyed by MRN."""
+
+        return self.repo._by_mrn
+
+    @property
+    def _apts_by_type(self):
+        """Appointment objects partitioned by _type."""
+
+        return self.repo._apts_by_type
+
+    @property
+    def patients(self):
+        """List of patient objects."""
+
+        return self.repo.patients
+
     def add_appointment(self, apt):
         """Saves appointment information.
 
@@ -49,27 +85,23 @@ class Application:
         Locates existing Patient if Patient exists, or instantiate new Patient, and instantiate _Appointment.
         """
 
-        if apt['_type'] == 'PeriodicExam':
-            exam = PeriodicExam(apt)
-        elif apt['_type'] == 'LimitedExam':
-            exam = LimitedExam(apt)
-        elif apt['_type'] == 'ComprehensiveExam':
-            exam = ComprehensiveExam(apt)
-        elif apt['_type'] == 'Surgery':
-            exam = Surgery(apt)
-        else:
-            log.error(f'({RUNTIME_ID}) Could not load record due to missing _type: {apt}')
+        exam_type = EXAM_TYPES.get(apt['_type'])
+        if exam_type is None:
+            log.error(f'({RUNTIME_ID}) Could not load record due to unknown _type: {apt}')
+            raise ValueError(f'Unknown appointment type: {apt["_type"]}')
+        exam = exam_type.from_dict(apt)
+        self.repo.index_appointment(exam)
 
-        if len(self.patients) > 0:
-            for patient in self.patients:
-                if patient == apt:
-                    patient.appointments.append(exam)
-                    log.debug(f'({RUNTIME_ID}) add_appointment(): {exam}')
-                    return
+        patient = self._by_mrn.get(Patient.key_from_dict(apt))
+        if patient is not None:
+            bisect.insort(patient.appointments, exam, key=by_date)  # Keep appointments sorted by date.
+            patient.mark_changed()
+            log.debug(f'({RUNTIME_ID}) add_appointment(): {exam}')
+            return
 
         new_patient = Patient(apt)
         new_patient.appointments.append(exam)
-        self.patients.append(new_patient)
+        self._by_mrn[new_patient.mrn] = new_patient
 
         log.debug(f'({RUNTIME_ID}) add_appointment(): {exam}')
 
@@ -84,7 +116,12 @@ class Application:
         Saves all Patient information to file.
         """
 
-        self.repo.save(self.patients)
+        # Records never loaded cannot have changed, so there is nothing to write.
+        if not self._repo_loaded:
+            log.debug(f'({RUNTIME_ID}) save(): Records not loaded. Nothing to save.')
+            return
+
+        self.repo.save(self._by_mrn.values())
 
         log.debug(f'({RUNTIME_ID}) save()')
 
@@ -96,36 +133,41 @@ class Application:
         Return:
             String describing changes.
 
-        Locates existing Patient if exists or replaces Patient object with object instantiated from argument.
+        Locates existing Patient if exists and updates its attributes from argument.
         """
 
         if type(person) != dict:
             log.error(f'({RUNTIME_ID}) modify_patient(): Argument type must be a dictionary. Current type is {type(person)}.')
 
-        for patient in self.patients:
-            if patient == person:
-                original = patient.to_dict()
-
-                before = {}
-                after = {}
-
-                for k, v in original.items():
-                    if v != person[k]:
-                        before[k] = v
-                        after[k] = person[k]
-
-                appointments = patient.appointments
-                person = Patient(person)
-                for appointment in appointments:
-                    person.appointments.append(appointment)
-
-                self.patients.remove(patient)
-                self.patients.append(person)
-
-                log.debug(f'({RUNTIME_ID}) modify_patient() has made the following changes have been made. {before} '
-                          f'has been changed to {after}.')
-
-        log.debug(f'({RUNTIME_ID}) modify_patient(): Patient not found.')
+        patient = self._by_mrn.get(Patient.key_from_dict(person))
+        if patient is None:
+            log.debug(f'({RUNTIME_ID}) modify_patient(): Patient not found.')
+            return
+
+        updated = {
+            'first': person['first'],
+            'last': person['last'],
+            'birthday': parse_date(person['birthday']),
+            'sex': intern_value(person['sex'])  # Shared like the sex of every other Patient; see Patient.__init__.
+        }
+
+        # Diff and update the existing Patient's attributes in place so its appointments and index entries stay
+        # untouched.
+        before = {}
+        after = {}
+        for k, v in updated.items():
+            current = getattr(patient, k)
+            if current != v:
+                # Report birthdays in DATE_FORMAT, as they were given, rather than as date objects.
+                before[k] = current.strftime(DATE_FORMAT) if k == 'birthday' else current
+                after[k] = v.strftime(DATE_FORMAT) if k == 'birthday' else v
+                setattr(patient, k, v)
+        patient.mark_changed()
+
+        changes = f'{before} has been changed to {after}.'
+        log.debug(f'({RUNTIME_ID}) modify_patient() has made the following changes have been made. {changes}')
+
+        return changes
 
     def modify_appointment(self, apt):
         """Changes an appointments information.
@@ -138,36 +180,38 @@ class Application:
         Locates existing _Appointment if exists or replaces _Appointment object with object instantiated from argument.
         """
 
-        if apt['_type'] == 'PeriodicExam':
-            exam = PeriodicExam(apt)
-        elif apt['_type'] == 'LimitedExam':
-            exam = LimitedExam(apt)
-        elif apt['_type'] == 'ComprehensiveExam':
-            exam = ComprehensiveExam(apt)
-        elif apt['_type'] == 'Surgery':
-            exam = Surgery(apt)
-        else:
-            log.error(f'({RUNTIME_ID}) modify_appointment(): Could not load record due to missing type: {apt}')
-
-        if len(self.patients) > 0:
-            for patient in self.patients:
-                if patient == apt:
-
-                    for appointment in patient.appointments:
-                        if appointment == exam:
-                            patient.appointments.remove(appointment)
-                            patient.appointments.append(exam)
-                            return f'{patient} appointment on {exam.date} has been updated.'
+        exam_type = EXAM_TYPES.get(apt['_type'])
+        if exam_type is None:
+            log.error(f'({RUNTIME_ID}) modify_appointment(): Could not load record due to unknown type: {apt}')
+            raise ValueError(f'Unknown appointment type: {apt["_type"]}')
+        exam = exam_type.from_dict(apt)
+
+        patient = self._by_mrn.get(Patient.key_from_dict(apt))
+        if patient is not None:
+            # Appointments are sorted by date, so only those sharing the new appointment's date need their type
+            # compared.
+            apts = patient.appointments
+            i = bisect.bisect_left(apts, exam.date, key=by_date)
+            while i < len(apts) and apts[i].date == exam.date:
+                appointment = apts[i]
+                if type(appointment) is type(exam):
+                    apts[i] = exam  # Same date, so the list stays sorted.
+                    patient.mark_changed()
+                    self.repo.unindex_appointment(appointment)
+                    self.repo.index_appointment(exam)
+                    return f'{patient} appointment on {exam.date} has been updated.'
+                i += 1
 
         log.error(f'({RUNTIME_ID}) modify_appointment(): Patient not found.')
 
-    def return_patient_records(self, mrn):
+    def return_patient_records(self, mrn, limit=None):
         """Returns a dictionary of Patient attributes as well as a list of dictionaries containing specific
         appointment attributes.
 
         Args:
             mrn (str): A string containing a representation of a patients mrn number.
             mrn (int): An integer representing a patients mrn number.
+            limit (int): OPTIONAL. Maximum number of appointments to return, most recent first. All when left blank.
         Return:
             patient_info (dict): Patient information.
             apt_records (list): List of dictionaries consisting of appointment information for patient.
@@ -186,19 +230,14 @@ class Application:
         apt_records = []
 
         # Determine if patient exists.
-        for patient in self.patients:
-            if patient == mrn:
-                patient_info = patient.to_dict()
-
-                # Compile patient records.
-                for record in patient.appointments:
-                    apt_records.append(record.to_dict())
-
-                # Sort patient records by date starting with most recent.
-                if len(apt_records) > 1:
-                    apt_records.sort(key=lambda x: x['date'], reverse=True)
-                break
-#
+        patient = self._by_mrn.get(mrn)
+        if patient is not None:
+            patient_info = patient.to_dict()
+
+            # Compile patient records starting with most recent. Appointments are kept sorted by date, oldest first, so
+            # only the first limit of them need converting. Each is copied as to_dict() returns a cached dictionary.
+            apt_records = [record.to_dict().copy() for record in islice(reversed(patient.appointments), limit)]
+
         if patient_info:
             log.debug('({}) return_patient_records(): Returning records for ({}, {} {})'
                       .format(RUNTIME_ID, patient_info['mrn'], patient_info['first'], patient_info['last']))
@@ -217,18 +256,22 @@ class Application:
             String describing success or failure of method.
         """
 
-        for patient in self.patients:
-            if patient.mrn == apt['mrn']:
+        patient = self._by_mrn.get(Patient.key_from_dict(apt))
+        if patient is not None:
 
-                # Make datetime.date() object for date comparison.
-                date_ = datetime.strptime(apt['date'], DATE_FORMAT).date()
+            # Make datetime.date() object for date comparison.
+            date_ = parse_date(apt['date'])
 
-                for appointment in patient.appointments:
-                    if appointment == date_:
-                        patient.appointments.remove(appointment)
-                        log.debug(f'({RUNTIME_ID}) delete_apt(): Appointment on {date_} for {patient.first.title()} '
-                                  f'{patient.last.title()} has been deleted.')
-                        return
+            # Appointments are sorted by date, so the first one on date_ is found by bisection.
+            apts = patient.appointments
+            i = bisect.bisect_left(apts, date_, key=by_date)
+            if i < len(apts) and apts[i].date == date_:
+                appointment = apts.pop(i)
+                patient.mark_changed()
+                self.repo.unindex_appointment(appointment)
+                log.debug(f'({RUNTIME_ID}) delete_apt(): Appointment on {date_} for {patient.first.title()} '
+                          f'{patient.last.title()} has been deleted.')
+                return
 
         log.error(f'({RUNTIME_ID}) delete_apt({apt}): Appointment not found.')
 
@@ -243,10 +286,19 @@ class Application:
             String describing success or failure of method.
         """
 
-        for patient in self.patients:
-            if patient == p:
-                self.patients.remove(patient)
-                log.debug(f'({RUNTIME_ID}) delete_patient(): {patient} has been deleted!')
+        if type(p) is dict:
+            mrn = Patient.key_from_dict(p)
+        elif type(p) is str:
+            mrn = p
+        else:
+            mrn = p.mrn
+
+        patient = self._by_mrn.pop(mrn, None)
+        if patient is not None:
+            for appointment in patient.appointments:
+                self.repo.unindex_appointment(appointment)
+            log.debug(f'({RUNTIME_ID}) delete_patient(): {patient} has been deleted!')
+            return
 
         log.error(f'({RUNTIME_ID}) delete_patient(): {p} has NOT been deleted! The patient cannot be found!')
 
@@ -262,78 +314,37 @@ class Application:
 
         log.debug(f'({RUNTIME_ID}) tally_stats({date_1}, {date_2})')
 
-        apts = []  # Dictionary of appointment stats for each _Appointment subclass.
+        stats = []  # Dictionary of appointment stats for each _Appointment subclass.
 
-        # Executes when both date arguments are provided.
-        if date_1 and date_2:
+        # If dates are type integer, convert to type string.
+        if type(date_1) is int:
+            date_1 = str(date_1)
+        if type(date_2) is int:
+            date_2 = str(date_2)
 
-            # If dates are type integer, convert to type string.
-            if type(date_1) is int:
-                date_1 = str(date_1)
-            if type(date_2) is int:
-                date_2 = str(date_2)
+        # Convert dates to datetime objects.
+        if type(date_1) is str:
+            date_1 = parse_date(date_1)
+        if type(date_2) is str:
+            date_2 = parse_date(date_2)
 
-            # Convert dates to datetime objects.
-            if type(date_1) is str:
-                date_1 = datetime.strptime(date_1, DATE_FORMAT).date()
-            if type(date_2) is str:
-                date_2 = datetime.strptime(date_2, DATE_FORMAT).date()
+        # Count procedures over the appointments of one _type at a time. Each appointment lists its procedures when it
+        # is instantiated, so Counter can total them without any per-appointment Python bytecode.
+        for _type in EXAM_TYPES:
+            # Isolate dates within argument date ranges when both date arguments are provided.
+            if date_1 and date_2:
+                apts = self.repo.appointments_between(_type, date_1, date_2)
+            else:
+                apts = self._apts_by_type[_type]
 
-            for patient in self.patients:
-                for appointment in patient.appointments:
-                    if date_1 < appointment.date < date_2:  # Isolate dates within argument date ranges.
-                        apts.append(appointment.to_stats_dict())
+            counter = {_type: len(apts)}
+            if apts:
+                # Kept for output compatibility: stats used to count every non-None key, including each 'date'.
+                counter['date'] = len(apts)
 
-        # Executes when date arguments are not provided.
-        else:
-            for patient in self.patients:
-                for appointment in patient.appointments:
-                    apts.append(appointment.to_stats_dict())
-
-        periodic = {'PeriodicExam': 0}
-        limited = {'LimitedExam': 0}
-        comprehensive = {'ComprehensiveExam': 0}
-        surgery = {'Surgery': 0}
-
-        for apt in apts:
-
-            if apt['_type'] == 'PeriodicExam':
-                periodic['PeriodicExam'] += 1
-                for k, v in apt.items():
-                    if v is not None:  # Eliminate procedure keys that did not happen during an appointment.
-                        if k in periodic:
-                            periodic[k] += 1
-                        elif k != '_type':
-                            periodic[k] = 1
-
-            elif apt['_type'] == 'LimitedExam':
-                limited['LimitedExam'] += 1
-                for k, v in apt.items():
-                    if v is not None:  # Eliminate procedure keys that did not happen during an appointment.
-                        if k in limited:
-                            limited[k] += 1
-                        elif k != '_type':
-                            limited[k] = 1
-
-            elif apt['_type'] == 'ComprehensiveExam':
-                comprehensive['ComprehensiveExam'] += 1
-                for k, v in apt.items():
-                    if v is not None:  # Eliminate procedure keys that did not happen during an appointment.
-                        if k in limited:
-                            comprehensive[k] += 1
-                        elif k != '_type':
-                            comprehensive[k] = 1
-
-            elif apt['_type'] == 'Surgery':
-                surgery['Surgery'] += 1
-                for k, v in apt.items():
-                    if v is not None:  # Eliminate procedure keys that did not happen during an appointment.
-                        if k in limited:
-                            surgery[k] += 1
-                        elif k != '_type':
-                            surgery[k] = 1
-
-        stats = [periodic, limited, comprehensive, surgery]
+            counter.update(Counter(chain.from_iterable(map(attrgetter('_procedures'), apts))))
+
+            stats.append(counter)
 
         log.debug(f'({RUNTIME_ID}) tally_stats() Return: {stats}')
 
@@ -356,10 +367,10 @@ class Application:
             log.error(f'({RUNTIME_ID}) find_patient({mrn}): Argument type must be a string or integer. Current type '
                       f'is {type(mrn)}.')
 
-        for patient in self.patients:
-            if patient.mrn == mrn:
-                log.debug(f'({RUNTIME_ID}) find_patient({mrn}) Return: {patient}')
-                return patient
+        patient = self._by_mrn.get(mrn)
+        if patient is not None:
+            log.debug(f'({RUNTIME_ID}) find_patient({mrn}) Return: {patient}')
+            return patient
 
         log.debug(f'({RUNTIME_ID}) find_patient({mrn}): Patient not found.')
 
@@ -510,66 +521,33 @@ def _add_mod_apt(instance, args):
         'sex': patient.sex
     }
 
-    apt_dict = {}
-    apt_args = args[1:]
-
-    # Deal with possible patient note. A note must be preceded with 'NOTE:', and each word must be separated with
-    # '-' rather than ' '.
-    note = None
-    for attribute in apt_args:
-        if attribute[:5] == 'NOTE:':
-            note = attribute[5:]  # Remove NOTE:
-            note = note.replace('-', ' ')
-            apt_dict['note'] = note
-            apt_args.remove(attribute)
-            continue
-
-    # Deal with possible patient asa.
-    asa = None
-    for attribute in apt_args:
-        if attribute[:5] == 'ASA:'.lower():
-            asa = attribute[5:]  # Remove asa:
-            apt_dict['asa'] = asa
-            apt_args.remove(attribute)
-            continue
+    apt_dict = {'_type': None}
+    procedures = []  # Remaining attributes, recorded as procedures that took place.
+
+    # Classify each appointment attribute in a single pass. A note must be preceded with 'NOTE:', and each word must be
+    # separated with '-' rather than ' '. An asa number must be preceded with 'ASA:' and a date with 'DATE:'.
+    for attribute in args[1:]:
+        if attribute.startswith('NOTE:'):
+            apt_dict['note'] = attribute[5:].replace('-', ' ')
+        elif attribute.startswith('ASA:'):
+            apt_dict['asa'] = attribute[4:]
+        elif attribute.startswith('DATE:'):
+            apt_dict['date'] = attribute[5:]
+        elif attribute in EXAM_TYPES:
+            apt_dict['_type'] = attribute
+        else:
+            procedures.append(attribute)
 
-    # Deal with appointment date.
-    date_ = None
-    for attribute in apt_args:
-        if attribute[:5] == 'DATE:':
-            date_ = attribute[5:]
-            apt_dict['date'] = date_
-            apt_args.remove(attribute)
-            continue
-    if date_ is None:
+    if 'date' not in apt_dict:
         log.error(f'({RUNTIME_ID}) Appointment date must be included.')
         return
 
-    # Deal with appointment type.
-    apt_dict['_type'] = None
-    for attribute in apt_args:
-        if attribute == 'PeriodicExam':
-            apt_dict['_type'] = 'PeriodicExam'
-            apt_args.remove(attribute)
-            continue
-        elif attribute == 'LimitedExam':
-            apt_dict['_type'] = 'LimitedExam'
-            apt_args.remove(attribute)
-            continue
-        elif attribute == 'ComprehensiveExam':
-            apt_dict['_type'] = 'ComprehensiveExam'
-            apt_args.remove(attribute)
-            continue
-        elif attribute == 'Surgery':
-            apt_dict['_type'] = 'Surgery'
-            apt_args.remove(attribute)
-            continue
     if apt_dict['_type'] is None:
         log.error(f'({RUNTIME_ID}) Appointment type must be included.')
         return
 
     # Populate the rest of apt_dict with remaining attributes.
-    for attribute in apt_args:
+    for attribute in procedures:
         apt_dict[attribute] = True
 
     return_dict = {**patient_dict, **apt_dict}
@@ -582,10 +560,13 @@ def main():
     # Initialize logging.
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=10 ** 107, backupCount=5)
+    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=LOG_MAX_BYTES, backupCount=5)
     handler.setFormatter(formatter)
 
-    log.addHandler(handler)
+    # Buffer records and write them to the file in batches. Errors are written immediately.
+    buffered_handler = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=handler)
+
+    log.addHandler(buffered_handler)
 
     log.debug(f'({RUNTIME_ID}) main()')
 
@@ -607,6 +588,7 @@ def main():
 
         log.debug(f'({RUNTIME_ID}) main() determined that program IS being run from cmd')
 
+        # Records are loaded only once a command below uses them, so --today never reads them.
         app = Application()
 
         # Application.find_patient('mrn')
@@ -1,14 +1,17 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import copy
+from dataclasses import dataclass, field, fields
 from datetime import datetime, date
 import logging
 from logging.handlers import RotatingFileHandler
+from typing import Any, ClassVar, overload
 import uuid
 
 DATE_FORMAT = '%Y%m%d'  # eg 20210123.
 LOG_FILENAME = 'core.log'  # Default filename for saving logging information for this module.
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Log file size at which it is rolled over to a backup.
+LOG_BUFFER_CAPACITY = 1024  # Log records held in memory before they are written to the log file.
 DEFAULT_LOG_LEVEL = logging.DEBUG  # Default logging level
 RUNTIME_ID = uuid.uuid4()  # Sets unique id for each runtime.
 
@@ -16,11 +19,73 @@ RUNTIME_ID = uuid.uuid4()  # Sets unique id for each runtime.
 log = logging.getLogger(__name__)  # Include module name.
 log.setLevel(DEFAULT_LOG_LEVEL)  # Set logging recording level.
 
+_DATE_CACHE: dict[str, date] = {}  # Parsed date objects keyed by their DATE_FORMAT string.
+# One shared str object for each distinct value of low cardinality fields such as sex and asa.
+_INTERN: dict[str, str] = {}
+
+
+def parse_date(date_string: str) -> date:
+    """Return a date object for a DATE_FORMAT string, parsing each unique string only once.
+
+    Args:
+        date_string (str): A date in DATE_FORMAT; eg 20210123
+    Return:
+        date_ (date): The date represented by date_string
+    """
+
+    try:
+        return _DATE_CACHE[date_string]
+    except KeyError:
+        pass
+
+    # DATE_FORMAT is fixed width, so well formed strings are sliced straight into a date. Anything else goes through
+    # strptime, which raises ValueError for malformed input.
+    if len(date_string) == 8 and date_string.isdigit():
+        date_ = date(int(date_string[:4]), int(date_string[4:6]), int(date_string[6:]))
+    else:
+        date_ = datetime.strptime(date_string, DATE_FORMAT).date()
+    _DATE_CACHE[date_string] = date_
+
+    return date_
+
+
+@overload
+def intern_value(value: str) -> str: ...
+
+
+@overload
+def intern_value(value: None) -> None: ...
+
+
+def intern_value(value: str | None) -> str | None:
+    """Return the shared copy of a repeated str value so equal values are held as one object.
+
+    Args:
+        value (str): A value drawn from a small set, eg 'male' or '3'
+        value (None): Returned unchanged
+    Return:
+        value (str): The first str seen that is equal to value
+    """
+
+    if value is None:
+        return None
+    return _INTERN.setdefault(value, value)
+
 
 class Patient:
     """Objects of this type represent periodontal patients."""
 
-    def __init__(self, patient_record):  # Accepts a dictionary of patient information.
+    __slots__ = ('mrn', 'first', 'last', 'birthday', 'sex', 'appointments', '_records')
+
+    mrn: str
+    first: str
+    last: str
+    birthday: date
+    sex: str
+    appointments: list['_Appointment']
+    _records: list[dict] | None
+
+    def __init__(self, patient_record: dict) -> None:  # Accepts a dictionary of patient information.
         """(Initialization)
 
         Args:
@@ -31,41 +96,46 @@ class Patient:
                 sex: Patient's sex; must be "male" or "female"
         """
 
-        self.mrn = patient_record['mrn']  # MRN is a individual health number unique to each patient.
+        self.mrn = self.key_from_dict(patient_record)  # MRN is a individual health number unique to each patient.
         self.first = patient_record['first']
         self.last = patient_record['last']
-        self.birthday = datetime.strptime(patient_record['birthday'], DATE_FORMAT).date()
-        self.sex = patient_record['sex']
+        self.birthday = parse_date(patient_record['birthday'])
+        self.sex = intern_value(patient_record['sex'])
         self.appointments = []  # Appointment Objects
+        self._records = None  # Records cached by self.to_records(); None until built or after self.mark_changed().
+
+        if log.isEnabledFor(logging.DEBUG):  # Called once per patient on load; skip formatting when not logged.
+            log.debug(f'{RUNTIME_ID} Patient(): Patient instance instantiated {self.mrn}, {self.first} {self.last}')
+
+    @classmethod
+    def key_from_dict(cls, patient_record: dict) -> str:
+        """Return the key identifying the patient a record belongs to.
+
+        Args:
+            patient_record (dict): A record of patient details, as accepted by Patient()
+        Return:
+            key (str): The patient's MRN; the value Patient.__eq__ compares and Repo indexes patients by
+        """
 
-        log.debug(f'{RUNTIME_ID} Patient(): Patient instance instantiated {self.mrn}, {self.first} {self.last}')
+        return patient_record['mrn']
 
-    def __eq__(self, other):
-        """Return True if MRN numbers match, False otherwise.
+    def __eq__(self, other: object) -> bool:
+        """Return True if other is a Patient with the same MRN number, False otherwise.
 
         Args:
             other (Patient): A Patient to compare with
-            other (dict): A dictionary containing a 'mrn' key
-            other (str): A string representation of a mrn number
         Return:
             is_equivalent (bool): True if MRN numbers match, False otherwise
+
+        Compare dicts and mrn strings against Patient.mrn directly.
         """
 
-        if type(other) is dict:
-            is_equivalent = self.mrn == other['mrn']
-            log_other = '{} {}'.format(other['mrn'], other['first'], other['last'])
-        elif type(other) is str:
-            is_equivalent = self.mrn == other
-            log_other = other  # Created for logging.
-        else:
-            is_equivalent = self.mrn == other.mrn
-            log_other = f'{other.mrn}, {other.first} {other.last}'  # Created for logging.
+        return isinstance(other, Patient) and self.mrn == other.mrn
 
-        log.debug(f'{RUNTIME_ID} Patient.__eq__: Patient ({self.mrn}, {self.first} {self.last}), compared with Other '
-                  f'Patient ({log_other}), equality = {is_equivalent}')
-        return is_equivalent
+    def __hash__(self) -> int:
+        return hash(self.mrn)
 
-    def __repr__(self):
+    def __repr__(self) -> str:
 
         # repr_ variable created to eliminate '\' from return string.
         repr_ = f'Patient(dict(mrn: {self.mrn}, first: {self.first.title()}, last: {self.last.title()}, ' \
@@ -73,7 +143,7 @@ class Patient:
 
         return repr_
 
-    def __str__(self):
+    def __str__(self) -> str:
 
         # str_ variable created to eliminate '\' from return string.
         str_ = f'Patient: {self.first.title()} {self.last.title()}, MRN: {self.mrn}, {self.sex.title()}, ' \
@@ -81,7 +151,7 @@ class Patient:
 
         return str_
 
-    def to_dict(self):
+    def to_dict(self) -> dict:
         """Return a copy of a dictionary representation of this Patient excluding self.appointments.
 
         Args:
@@ -90,276 +160,223 @@ class Patient:
             record (dict): A dictionary of this object's attrs as keys, and their values
         """
 
-        # copy.copy used so record.pop('appointments') will not change Patient object.
-        record = copy.copy(self.__dict__)
-        record['birthday'] = self.birthday.strftime(DATE_FORMAT)
-        record.pop('appointments')
-
-        log.debug(f'{RUNTIME_ID} Patient.to_dict(): Dictionary representation created for ({self.mrn}, {self.first} '
-                  f'{self.last})')
+        record = {
+            'mrn': self.mrn,
+            'first': self.first,
+            'last': self.last,
+            'birthday': self.birthday.strftime(DATE_FORMAT),
+            'sex': self.sex
+        }
+
+        if log.isEnabledFor(logging.DEBUG):  # Called once per patient on save; skip formatting when not logged.
+            log.debug(f'{RUNTIME_ID} Patient.to_dict(): Dictionary representation created for ({self.mrn}, '
+                      f'{self.first} {self.last})')
         return record
 
-
-class _Appointment:
-    """(ABC) Appointments are either Appointments or Exams representing various Periodontal visit types."""
-
-    def __init__(self, date_, asa='No ASA number.', note='No note.'):
-        """(Initialization)
-
-        Args:
-            date_ (object): datetime object.
-            asa (str): OPTIONAL. String representation of an mrn number.
-            note (str): OPTIONAL. Appointment note.
-        """
-
-        self.date = datetime.strptime(date_, DATE_FORMAT).date()
-        self.asa = asa  # range from 1 to 5. Identifies overall patient health.
-        self.note = note
-
-        log.debug(f'{RUNTIME_ID} Appointment(): Appointment instance instantiated: {self}')
-
-    def to_dict(self):
-        """Return a dictionary representation of this appointment.
+    def to_records(self) -> list[dict]:
+        """Return a dictionary representation of each of this Patient's appointments merged with this Patient's own.
 
         Args:
             None
         Return:
-            record (dict): A dictionary of this object's attrs as keys, and their values
-        """
+            records (list): Dictionaries of patient and appointment attrs as keys, and their values
 
-        record = copy.copy(self.__dict__)
-        record['date'] = self.date.strftime(DATE_FORMAT)
-        record['_type'] = self.__class__.__name__
+        The list is cached and reused by later calls until self.mark_changed() is called.
+        """
 
-        log.debug(f'{RUNTIME_ID} Appointment.to_dict(): ({self})')
+        if self._records is None:
+            patient_info = self.to_dict()
+            records = []
+            for appointment in self.appointments:
+                record = patient_info.copy()
+                record.update(appointment.to_dict())
+                records.append(record)
+            self._records = records
 
-        return record
+        return self._records
 
-    def to_stats_dict(self):
-        """Returns a copy of a dictionary representation of this Appointment with only the information needed for
-        processing statistics.
+    def mark_changed(self) -> None:
+        """Discards the records cached by self.to_records(). Call after changing this Patient or its appointments.
 
         Args:
             None
         Return:
-            record (dict): A dictionary copy of this object's attrs as keys, and their values, excluding self.note and
-            self.asa.
+            None
         """
 
-        record = copy.copy(self.to_dict())  # Copy dictionary so manipulation will not affect the instance.
-        record.pop('note')
-        record.pop('asa')
-
-        log.debug(f'{RUNTIME_ID} Appointment.to_stats_dict(): ({self})')
+        self._records = None
 
-        return record
 
-    def __str__(self):
-        return f'{self.__class__.__name__} on {self.date}'
+@dataclass(frozen=True, slots=True, eq=False)
+class _Appointment:
+    """(ABC) Appointments are either Appointments or Exams representing various Periodontal visit types.
 
+    Subclasses declare each of their procedures as a field defaulting to None; those fields are the procedures counted
+    by tally_stats.
 
-class PeriodicExam(_Appointment):
-    """Child class of Appointment."""
+    Appointments are frozen; to change one, replace it with a new instance. _procedures and the dictionary cached by
+    to_dict are both derived from the fields once, which is only safe because the fields cannot change.
+    """
 
-    # TODO (GS): say what a Periodoc exam is in the docstring
+    date: date
+    asa: Any = 'No ASA number.'  # range from 1 to 5. Identifies overall patient health.
+    note: Any = 'No note.'
+    _type: str = field(init=False, repr=False)  # Subclass name, stored once for to_dict and stats.
+    _procedures: tuple = field(init=False, repr=False)  # Names of the procedures that happened.
+    _cached_dict: dict | None = field(default=None, init=False, repr=False)  # Built once by to_dict.
 
-    def __init__(self, exam_dict):
+    _STAT_FIELDS: ClassVar[tuple] = ()  # Procedure fields of each subclass; set below once every subclass is defined.
 
-        super().__init__(date_=exam_dict['date'],
-                         asa=exam_dict.get('asa'),
-                         note=exam_dict.get('note')
-                         )
+    def __post_init__(self) -> None:
 
-    def __eq__(self, other):
-        """Return True if other is deemed equal to this PeriodicExam.
-
-        Args:
-            other (date object): A date object to compare against the date object of this class
-            other (_Appointment object): True if class names match AND dates match
-        Return:
-            is_equivalent (bool): True if other is a date object and date objects match, or true if other is a class
-            object and date objects and class name objects match, False otherwise
-        """
+        # The dataclass is frozen, so derived attributes are set through object.__setattr__.
+        object.__setattr__(self, '_type', type(self).__name__)
+        object.__setattr__(self, 'asa', intern_value(self.asa))
 
-        if type(other) is date:
-            is_equivalent = self.date == other
-        else:
-            is_equivalent = self.date == other.date and self.__class__.__name__ == other.__class__.__name__
+        # Listed once here so tally_stats can count procedures without re-reading every attribute. Safe to cache as the
+        # dataclass is frozen.
+        object.__setattr__(self, '_procedures',
+                           tuple(name for name in self._STAT_FIELDS if getattr(self, name) is not None))
 
-        return is_equivalent
+        if log.isEnabledFor(logging.DEBUG):  # Called once per appointment on load; skip formatting when not logged.
+            log.debug(f'{RUNTIME_ID} Appointment(): Appointment instance instantiated: {self}')
 
-    def to_dict(self):
-        """Return a dictionary representation of this PeriodicExam.
+    @classmethod
+    def from_dict(cls, exam_dict: dict) -> '_Appointment':
+        """Return an appointment of this class built from a dictionary representation.
 
         Args:
-            None
+            exam_dict (dict): A dictionary of appointment attributes. 'date' must be in DATE_FORMAT; any other key that
+            is not a field of this class is ignored.
         Return:
-            record (dict): A dictionary representation of this object's attrs as keys, and their values
+            exam (_Appointment): An instance of cls
         """
 
-        record = super().to_dict()
-
-        return record
-
+        procedures = {name: exam_dict.get(name) for name in cls._STAT_FIELDS}
+        return cls(parse_date(exam_dict['date']), exam_dict.get('asa'), exam_dict.get('note'), **procedures)
 
-class LimitedExam(_Appointment):
-    """Child class of Appointment."""
-
-    # TODO (GS) say what a Limited Exam is in the docstring.
-
-    def __init__(self, exam_dict):
-
-        super().__init__(date_=exam_dict['date'],
-                         asa=exam_dict.get('asa'),
-                         note=exam_dict.get('note')
-                         )
-
-        self.abscess = exam_dict.get('abscess')
-        self.crown_lengthening = exam_dict.get('crown_lengthening')
-        self.cv_exam = exam_dict.get('cv_exam')
-        self.extraction = exam_dict.get('extraction')
-        self.frenectomy = exam_dict.get('frenectomy')
-        self.fracture = exam_dict.get('fracture')
-        self.implant = exam_dict.get('implant')
-        self.oral_path = exam_dict.get('oral_path')
-        self.periodontitis = exam_dict.get('periodontitis')
-        self.peri_implantitis = exam_dict.get('peri_implantitis')
-        self.postop = exam_dict.get('postop')
-        self.return_ = exam_dict.get('return_')
-        self.recession = exam_dict.get('recession')
-        self.re_evaluation = exam_dict.get('re_evaluation')
-        self.miscellaneous = exam_dict.get('miscellaneous')
-
-    def __eq__(self, other):
-        """Return True if other is deemed equal to this LimitedExam.
+    def __eq__(self, other: object) -> bool:
+        """Return True if other is deemed equal to this appointment.
 
         Args:
             other (date object): A date object to compare against the date object of this class
-            other (_Appointment object): True if class names match AND dates match
+            other (_Appointment object): True if classes match AND dates match
         Return:
             is_equivalent (bool): True if other is a date object and date objects match, or true if other is a class
-            object and date objects and class name objects match, False otherwise
+            object and date objects and classes match, False otherwise
         """
 
         if type(other) is date:
             is_equivalent = self.date == other
+        elif isinstance(other, _Appointment):
+            is_equivalent = self.date == other.date and type(self) is type(other)
         else:
-            is_equivalent = self.date == other.date and self.__class__.__name__ == other.__class__.__name__
+            is_equivalent = False
 
         return is_equivalent
 
-    def to_dict(self):
-        """Return a dictionary representation of this LimitedExam.
+    def to_dict(self) -> dict:
+        """Return a dictionary representation of this appointment.
+
         Args:
             None
         Return:
-            record (dict): A dictionary representation of this object's attrs as keys, and their values
-            """
+            record (dict): A dictionary of this object's attrs as keys, and their values
 
-        record = super().to_dict()
+        The dictionary is cached and returned by every later call, so it must not be modified; copy it first.
+        """
 
-        return record
+        if self._cached_dict is not None:
+            return self._cached_dict
 
+        record = {'date': self.date.strftime(DATE_FORMAT), 'asa': self.asa, 'note': self.note}
+        for name in self._STAT_FIELDS:
+            record[name] = getattr(self, name)
+        record['_type'] = self._type
+        object.__setattr__(self, '_cached_dict', record)  # Frozen; see __post_init__.
 
-class ComprehensiveExam(_Appointment):
-    """Child class of Appointment."""
-    # TODO (GS): Say what a Comprehensive Exam is
-    def __init__(self, exam_dict):
-        super().__init__(date_=exam_dict['date'],
-                         asa=exam_dict.get('asa'),
-                         note=exam_dict.get('note')
-                         )
-
-        self.periodontitis = exam_dict.get('periodontitis')
-        self.executive_health = exam_dict.get('executive_health')
-        self.recession = exam_dict.get('recession')
-        self.hygiene = exam_dict.get('hygiene')
-        self.return_ = exam_dict.get('return_')
-        self.oncology = exam_dict.get('oncology')
-        self.implant = exam_dict.get('implant')
-        self.oral_path = exam_dict.get('oral_path')
-
-    def __eq__(self, other):
-        """Return True if other is deemed equal to this ComprehensiveExam.
+        if log.isEnabledFor(logging.DEBUG):  # Called once per appointment on save; skip formatting when not logged.
+            log.debug(f'{RUNTIME_ID} Appointment.to_dict(): ({self})')
 
-        Args:
-            other (date object): A date object to compare against the date object of this class
-            other (_Appointment object): True if class names match AND dates match
-        Return:
-            is_equivalent (bool): True if other is a date object and date objects match, or true if other is a class
-            object and date objects and class name objects match, False otherwise
-        """
+        return record
 
-        if type(other) is date:
-            is_equivalent = self.date == other
-        else:
-            is_equivalent = self.date == other.date and self.__class__.__name__ == other.__class__.__name__
+    def __str__(self) -> str:
+        return f'{self._type} on {self.date}'
 
-        return is_equivalent
 
-    def to_dict(self):
-        """Return a dictionary representation of this ComprehensiveExam.
-        Args:
-            None
-        Return:
-            record (dict): A dictionary representation of this object's attrs as keys, and their values
-        """
-
-        record = super().to_dict()
+@dataclass(frozen=True, slots=True, eq=False)
+class PeriodicExam(_Appointment):
+    """Child class of Appointment."""
 
-        return record
+    # TODO (GS): say what a Periodoc exam is in the docstring
 
 
-class Surgery(_Appointment):
+@dataclass(frozen=True, slots=True, eq=False)
+class LimitedExam(_Appointment):
     """Child class of Appointment."""
 
-    def __init__(self, exam_dict):
+    # TODO (GS) say what a Limited Exam is in the docstring.
 
-        super().__init__(date_=exam_dict['date'],
-                         asa=exam_dict.get('asa'),
-                         note=exam_dict.get('note')
-                         )
+    abscess: Any = None
+    crown_lengthening: Any = None
+    cv_exam: Any = None
+    extraction: Any = None
+    frenectomy: Any = None
+    fracture: Any = None
+    implant: Any = None
+    oral_path: Any = None
+    periodontitis: Any = None
+    peri_implantitis: Any = None
+    postop: Any = None
+    return_: Any = None
+    recession: Any = None
+    re_evaluation: Any = None
+    miscellaneous: Any = None
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class ComprehensiveExam(_Appointment):
+    """Child class of Appointment."""
 
-        self.biopsy = exam_dict.get('biopsy')
-        self.extractions = exam_dict.get('extractions')
-        self.uncovery = exam_dict.get('uncovery')
-        self.implant = exam_dict.get('implant')
-        self.crown_lengthening = exam_dict.get('crown_lengthening')
-        self.soft_tissue = exam_dict.get('soft_tissue')
-        self.perio = exam_dict.get('perio')
-        self.miscellaneous = exam_dict.get('miscellaneous')
-        self.sinus = exam_dict.get('sinus')
-        self.peri_implantitis = exam_dict.get('peri_implantitis')
+    # TODO (GS): Say what a Comprehensive Exam is
 
-    def __eq__(self, other):
-        """Return True if other is deemed equal to this Surgery.
+    periodontitis: Any = None
+    executive_health: Any = None
+    recession: Any = None
+    hygiene: Any = None
+    return_: Any = None
+    oncology: Any = None
+    implant: Any = None
+    oral_path: Any = None
 
-        Args:
-            other (date object): A date object to compare against the date object of this class
-            other (_Appointment object): True if class names match AND dates match
-        Return:
-            is_equivalent (bool): True if other is a date object and date objects match, or true if other is a class
-            object and date objects and class name objects match, False otherwise
-        """
 
-        if type(other) is date:
-            is_equivalent = self.date == other
-        else:
-            is_equivalent = self.date == other.date and self.__class__.__name__ == other.__class__.__name__
+@dataclass(frozen=True, slots=True, eq=False)
+class Surgery(_Appointment):
+    """Child class of Appointment."""
 
-        return is_equivalent
+    biopsy: Any = None
+    extractions: Any = None
+    uncovery: Any = None
+    implant: Any = None
+    crown_lengthening: Any = None
+    soft_tissue: Any = None
+    perio: Any = None
+    miscellaneous: Any = None
+    sinus: Any = None
+    peri_implantitis: Any = None
 
-    def to_dict(self):
-        """Return a dictionary representation of this Surgery.
-        Args:
-            None
-        Return:
-            record (dict): A dictionary representation of this object's attrs as keys, and their values
-        """
 
-        record = super().to_dict()
+EXAM_TYPES: dict[str, type[_Appointment]] = {
+    'PeriodicExam': PeriodicExam,
+    'LimitedExam': LimitedExam,
+    'ComprehensiveExam': ComprehensiveExam,
+    'Surgery': Surgery
+}  # _Appointment subclasses keyed by the _type stored with each record.
 
-        return record
+# Each subclass's procedures are the init fields it adds to _Appointment.
+for _exam_type in EXAM_TYPES.values():
+    _exam_type._STAT_FIELDS = tuple(f.name for f in fields(_exam_type)
+                                    if f.init and f.name not in ('date', 'asa', 'note'))
 
 
 def main():
@@ -367,10 +384,13 @@ def main():
     # Logging.
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=10 ** 107, backupCount=5)
+    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=LOG_MAX_BYTES, backupCount=5)
     handler.setFormatter(formatter)
 
-    log.addHandler(handler)
+    # Buffer records and write them to the file in batches. Errors are written immediately.
+    buffered_handler = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=handler)
+
+    log.addHandler(buffered_handler)
 
     # Testing.
     self_test()
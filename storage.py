@@ -1,37 +1,67 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from core import Patient, LimitedExam, PeriodicExam, ComprehensiveExam, Surgery, RUNTIME_ID
+import bisect
+from core import Patient, EXAM_TYPES, RUNTIME_ID, _Appointment
+from datetime import date
+from itertools import groupby
+import json
 import logging
 from logging.handlers import RotatingFileHandler
+from operator import attrgetter, itemgetter
+import os
+from typing import Iterable, Iterator
 import yaml
 
-RECORDS_FILENAME = 'records.yaml'  # Default filename for saving and loading records.
+try:
+    import orjson  # Optional. Faster drop-in for json when installed.
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+RECORDS_FILENAME = 'records.json'  # Default filename for saving and loading records.
+YAML_EXTENSIONS = ('.yaml', '.yml')  # Records files with these extensions are read and written as YAML.
+TEMP_SUFFIX = '.tmp'  # Appended to the records filename while a save is written.
 LOG_FILENAME = 'storage.log'  # Default filename for saving logging information for this module.
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Log file size at which it is rolled over to a backup.
+LOG_BUFFER_CAPACITY = 1024  # Log records held in memory before they are written to the log file.
 DEFAULT_LOG_LEVEL = logging.DEBUG  # Default logging level.
 
 # Configure logging.
 log = logging.getLogger(__name__)  # Include module name.
 log.setLevel(DEFAULT_LOG_LEVEL)  # Set logging recording leve.
 
+by_date = attrgetter('date')  # Sort key for appointment objects.
+
+# libyaml backed loader and dumper, falling back to the pure Python ones when PyYAML was built without libyaml.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class Repo:
 
-    def __init__(self, records_path=RECORDS_FILENAME):
+    def __init__(self, records_path: str = RECORDS_FILENAME) -> None:
         """(Initialization)
 
         Args:
             records_path (string): A file name in which to save and load patient/appointment information. File type must
-            by .yaml. Arg defaults to 'records-v6.yaml' when left blank.
+            be .json, or .yaml or .yml for legacy records. Arg defaults to 'records.json' when left blank.
         Return:
             None
         """
 
-        self.records_path = records_path
-        self.patients = []  # List of all patients as objects.
+        self.records_path: str = records_path
+        self._by_mrn: dict[str, Patient] = {}  # Patient objects keyed by MRN, in the order they were added.
+        # Appointment objects partitioned by _type, each partition sorted by date for range queries.
+        self._apts_by_type: dict[str, list[_Appointment]] = {_type: [] for _type in EXAM_TYPES}
         log.debug(f'{RUNTIME_ID} Repo(): Repo instance instantiated.')
 
-    def load(self):
+    @property
+    def patients(self) -> list[Patient]:
+        """List of all patients as objects, in the order they were added."""
+
+        return list(self._by_mrn.values())
+
+    def load(self) -> None:
         """Loads saved information from source files.
 
         Args:
@@ -45,28 +75,68 @@ class Repo:
         log.debug(f'{RUNTIME_ID} load(): instantiated.')
 
         # records is a dictionary representing all patient appointments, and includes patient and appointment data.
-        records = self._get_from_yaml()
+        records: Iterable[dict]
+        if os.path.splitext(self.records_path)[1] in YAML_EXTENSIONS:
+            records = self._get_from_yaml(self.records_path)
+        else:
+            records = self._get_from_json()
         self._load_obj(records)
 
         log.debug(f'{RUNTIME_ID} load(): Program records loaded in Repo.patients')
 
-    def _load_obj(self, records):
-        # Passes each patient record (as a dictionary) to self.new_record() where it will become a Patient object with
-        # Patient.appointments populated with appropriate Appointment objects.
-        for record in records:
-            self._add_record(record)
-
-    def _get_from_yaml(self):
-        # Retrieves dictionary representations of patient and appointment information from a .yaml file.
-        raw_records = []
-        with open(RECORDS_FILENAME, 'r') as infile:
-            records = yaml.full_load(infile)
-            for record in records:
-                raw_records.append(record)
-        log.debug(f'{RUNTIME_ID} _get_from_yaml(): Records pulled from {RECORDS_FILENAME}')
-        return raw_records
-
-    def save(self, patients):
+    def _load_obj(self, records: Iterable[dict]) -> None:
+        # Passes each patient record (as a dictionary) to self._add_record() where it will become a Patient object with
+        # Patient.appointments populated with appropriate Appointment objects. Records are saved grouped by _type, so
+        # each run of one _type is dispatched to its _Appointment subclass once.
+        for _type, group in groupby(records, key=itemgetter('_type')):
+            exam_type = EXAM_TYPES.get(_type)
+            if exam_type is None:
+                log.critical(f'{RUNTIME_ID} _load_obj(): Could not load record due to unknown _type: {_type}')
+                raise ValueError(f'Unknown appointment type: {_type}')
+            for record in group:
+                self._add_record(record, exam_type)
+
+        # _add_record appends appointments unsorted; sort each list by date once now that every record is in.
+        for apts in self._apts_by_type.values():
+            apts.sort(key=by_date)
+        for patient in self._by_mrn.values():
+            patient.appointments.sort(key=by_date)
+
+    def _get_from_json(self) -> list[dict]:
+        # Retrieves dictionary representations of patient and appointment information from a .json file. Records still
+        # kept in the legacy .yaml file of the same name are migrated to .json the first time they are loaded.
+        legacy_path = os.path.splitext(self.records_path)[0] + '.yaml'
+        if not os.path.exists(self.records_path) and os.path.exists(legacy_path):
+            records = list(self._get_from_yaml(legacy_path))
+            self._push_to_json(records)
+            log.debug(f'{RUNTIME_ID} _get_from_json(): Records migrated from {legacy_path} to {self.records_path}')
+            return records
+
+        # Read as bytes for both backends; json.loads detects UTF-8 itself rather than using the locale's encoding.
+        with open(self.records_path, 'rb') as infile:
+            data = infile.read()
+        if orjson is not None:
+            records = orjson.loads(data)
+        else:
+            records = json.loads(data)
+        log.debug(f'{RUNTIME_ID} _get_from_json(): Records pulled from {self.records_path}')
+        return records
+
+    def _get_from_yaml(self, records_path: str) -> Iterator[dict]:
+        # Yields dictionary representations of patient and appointment information from a .yaml file as each document
+        # is parsed. Records are saved one per document; older files hold a single document listing every record.
+        # The file is read as bytes in one call and libyaml decodes it itself, instead of reading and decoding it in
+        # small chunks.
+        with open(records_path, 'rb') as infile:
+            data = infile.read()
+        for document in yaml.load_all(data, Loader=_YAML_LOADER):
+            if type(document) is list:
+                yield from document
+            else:
+                yield document
+        log.debug(f'{RUNTIME_ID} _get_from_yaml(): Records pulled from {records_path}')
+
+    def save(self, patients: Iterable[Patient]) -> None:
         """Saves all information to source file.
 
         Args:
@@ -74,28 +144,48 @@ class Repo:
         Return:
             None
 
-        Converts patient objects to dictionary representations and then uses self._push_to_yaml to populate
-        self.patients with a complete list of Patient objects.
+        Converts patient objects to dictionary representations and then uses self._push_to_json, or self._push_to_yaml
+        for legacy .yaml records, to write them to self.records_path.
         """
 
         log.debug(f'{RUNTIME_ID} save() instantiated.')
 
-        records = []  # List of appointment dictionaries.
-
-        for patient in patients:
-            patient_info = patient.to_dict()
-            for appointment in patient.appointments:
-                appointment_info = appointment.to_dict()
-                record = {**patient_info, **appointment_info}
-                records.append(record)
-                log.debug(f'{RUNTIME_ID} save(): Patient {record["mrn"]}, appointment on date {record["date"]}, '
-                          f'converted to dict and compiled for saving')
+        # List of appointment dictionaries. Patients unchanged since the last save reuse their cached records.
+        records = [record for patient in patients for record in patient.to_records()]
+        records.sort(key=itemgetter('_type'))  # Group by _type for self._load_obj; the sort is stable.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'{RUNTIME_ID} save(): {len(records)} appointments converted to dict and compiled for saving')
 
-        self._push_to_yaml(records)
+        if os.path.splitext(self.records_path)[1] in YAML_EXTENSIONS:
+            self._push_to_yaml(records)
+        else:
+            self._push_to_json(records)
 
         log.debug(f'{RUNTIME_ID} save(): Program saved')
 
-    def _push_to_yaml(self, records):
+    def _push_to_json(self, records: list[dict]) -> None:
+        """Saves all information to a .json file.
+
+        Args:
+            records (list): A list of dictionaries representing patient appointments.
+        Return:
+            None
+        """
+
+        log.debug(f'{RUNTIME_ID} _push_to_json(): instantiated.')
+
+        # Written to a temporary file first, so a failed or interrupted save leaves the previous records intact.
+        temp_path = self.records_path + TEMP_SUFFIX
+        if orjson is not None:
+            with open(temp_path, 'wb') as json_outfile:
+                json_outfile.write(orjson.dumps(records))
+        else:
+            with open(temp_path, 'w', encoding='utf-8') as json_outfile:
+                json.dump(records, json_outfile)
+        os.replace(temp_path, self.records_path)
+        log.debug(f'{RUNTIME_ID} _push_to_json(): Records pushed to {self.records_path}')
+
+    def _push_to_yaml(self, records: list[dict]) -> None:
         """Saves all information to a .yaml file.
 
         Args:
@@ -108,48 +198,92 @@ class Repo:
 
         log.debug(f'{RUNTIME_ID} _push_to_yaml(): instantiated.')
 
-        with open(RECORDS_FILENAME, 'w') as yaml_outfile:
-            yaml.dump(records, yaml_outfile)
-        log.debug(f'{RUNTIME_ID} _push_to_yaml(): Records pushed to {RECORDS_FILENAME}')
+        # Emitted straight into the file one document at a time rather than built as one string first. Written to a
+        # temporary file, so a failed or interrupted save leaves the previous records intact.
+        temp_path = self.records_path + TEMP_SUFFIX
+        with open(temp_path, 'wb') as yaml_outfile:
+            yaml.dump_all(records, yaml_outfile, Dumper=_YAML_DUMPER, encoding='utf-8')
+        os.replace(temp_path, self.records_path)
+        log.debug(f'{RUNTIME_ID} _push_to_yaml(): Records pushed to {self.records_path}')
 
-    def _add_record(self, apt):
+    def _add_record(self, apt: dict, exam_type: type[_Appointment]) -> None:
         """Substantiates Patient objects with relevant information and adds patient to self.patients.
 
         Args:
             apt (dict): A dictionary containing patient and appointment information for one appointment.
+            exam_type (class): The EXAM_TYPES value for apt['_type'].
         Return:
             None
 
         Helper function for self.load to populate self.patients with a list of patient objects.
         """
 
-        if apt['_type'] == 'PeriodicExam':
-            exam = PeriodicExam(apt)
-        elif apt['_type'] == 'LimitedExam':
-            exam = LimitedExam(apt)
-        elif apt['_type'] == 'ComprehensiveExam':
-            exam = ComprehensiveExam(apt)
-        elif apt['_type'] == 'Surgery':
-            exam = Surgery(apt)
-        else:
-            log.critical(f'{RUNTIME_ID} _add_record(): Could not load record due to missing _type')
-
-        if len(self.patients) > 0:
-            for patient in self.patients:
-                if patient == apt:
-                    patient.appointments.append(exam)
-                    log.debug(
-                        f'{RUNTIME_ID} _add_record(): Patient {apt["mrn"]}, appointment date {apt["date"]}. Patient '
-                        f'object exists. Appointment substantiated as object and added existing patient object '
-                        f'appointments list.')
-                    return
+        mrn = Patient.key_from_dict(apt)
+        exam = exam_type.from_dict(apt)
+        self._apts_by_type[exam._type].append(exam)
+
+        patient = self._by_mrn.get(mrn)
+        if patient is not None:
+            patient.appointments.append(exam)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f'{RUNTIME_ID} _add_record(): Patient {mrn}, appointment date {apt["date"]}. Patient '
+                          f'object exists. Appointment substantiated as object and added existing patient object '
+                          f'appointments list.')
+            return
 
         new_patient = Patient(apt)
         new_patient.appointments.append(exam)
-        self.patients.append(new_patient)
-        log.debug(f'{RUNTIME_ID} _add_record(): Patient {apt["mrn"]}, appointment date {apt["date"]}, Patient and '
-                  f'appointment substantiated as objects. Apt added to patient objects appointment list, and patient '
-                  f'added to self.patients')
+        self._by_mrn[mrn] = new_patient
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'{RUNTIME_ID} _add_record(): Patient {mrn}, appointment date {apt["date"]}, Patient and '
+                      f'appointment substantiated as objects. Apt added to patient objects appointment list, and '
+                      f'patient added to self.patients')
+
+    def index_appointment(self, appointment: _Appointment) -> None:
+        """Adds an appointment to the partition for its _type, keeping the partition sorted by date.
+
+        Args:
+            appointment (_Appointment): An appointment object held by one of self.patients.
+        Return:
+            None
+        """
+
+        bisect.insort(self._apts_by_type[appointment._type], appointment, key=by_date)
+
+    def unindex_appointment(self, appointment: _Appointment) -> None:
+        """Removes an appointment from the partition for its _type.
+
+        Args:
+            appointment (_Appointment): An appointment object previously passed to self.index_appointment.
+        Return:
+            None
+        """
+
+        # Search only the appointments sharing its date, matching on identity; _Appointment.__eq__ treats any two
+        # appointments of one type on one date as equal.
+        apts = self._apts_by_type[appointment._type]
+        i = bisect.bisect_left(apts, appointment.date, key=by_date)
+        while i < len(apts) and apts[i].date == appointment.date:
+            if apts[i] is appointment:
+                del apts[i]
+                return
+            i += 1
+
+    def appointments_between(self, _type: str, date_1: date, date_2: date) -> list[_Appointment]:
+        """Returns the appointments of one _type dated strictly between two dates.
+
+        Args:
+            _type (str): A key of EXAM_TYPES.
+            date_1 (object): A date object for minimum date for range.
+            date_2 (object): A date object for maximum date for range.
+        Return:
+            apts (list): Appointment objects sorted by date.
+        """
+
+        apts = self._apts_by_type[_type]
+        lo = bisect.bisect_right(apts, date_1, key=by_date)
+        hi = bisect.bisect_left(apts, date_2, key=by_date)
+        return apts[lo:hi]
 
 
 def main():
@@ -157,10 +291,13 @@ def main():
     # Logging
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=10**107, backupCount=5)
+    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=LOG_MAX_BYTES, backupCount=5)
     handler.setFormatter(formatter)
 
-    log.addHandler(handler)
+    # Buffer records and write them to the file in batches. Errors are written immediately.
+    buffered_handler = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=handler)
+
+    log.addHandler(buffered_handler)
 
     # Testing.
     self_test()